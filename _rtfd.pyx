@@ -0,0 +1,99 @@
+# cython: language_level=3, boundscheck=False, wraparound=False
+
+# Copyright (c) 2004-2021 Primate Labs Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+
+# Compiled version of datastore.read_rtf_item_mv(). Build in place with
+#
+#   cythonize -i _rtfd.pyx
+#
+# datastore falls back to the pure Python parser when this module has not been
+# built.
+
+from cpython.unicode cimport PyUnicode_DecodeUTF8
+from libc.stdint cimport uint32_t
+
+
+cdef uint32_t _u32(const unsigned char[::1] buf, Py_ssize_t offset, Py_ssize_t end) except? 0xffffffff:
+    if offset + 4 > end:
+        raise ValueError('Truncated RTFD item')
+    return (<uint32_t>buf[offset] |
+            (<uint32_t>buf[offset + 1] << 8) |
+            (<uint32_t>buf[offset + 2] << 16) |
+            (<uint32_t>buf[offset + 3] << 24))
+
+
+# Item contents are returned as slices of mv rather than copies, so attachments
+# that the caller never looks at are not copied.
+cdef object _slice(object mv, Py_ssize_t start, Py_ssize_t size, Py_ssize_t end):
+    if start > end:
+        start = end
+    if size > end - start:
+        size = end - start
+    return mv[start:start + size]
+
+
+cdef object _parse(object mv, const unsigned char[::1] buf, Py_ssize_t offset, Py_ssize_t end):
+    cdef uint32_t item_type, item_size, padding_size, real_size, n_items, attr_len
+    cdef Py_ssize_t i, sizes_offset, child_end
+
+    item_type = _u32(buf, offset, end)
+    offset += 4
+    if item_type == 1:
+        # single item
+        item_size = _u32(buf, offset, end)
+        offset += 4
+        if item_size == 2147483648:  # 00 00 00 80 means it is a big file w padding
+            padding_size = _u32(buf, offset, end)
+            real_size = _u32(buf, offset + 4, end)
+            return _slice(mv, offset + 8 + padding_size, real_size, end)
+        return _slice(mv, offset, item_size, end)
+    elif item_type == 3:
+        n_items = _u32(buf, offset, end)
+        offset += 4
+        item_names = []
+        for i in range(n_items):
+            attr_len = _u32(buf, offset, end)
+            offset += 4
+            if attr_len > end - offset:
+                raise ValueError('Truncated RTFD item')
+            item_names.append(PyUnicode_DecodeUTF8(<const char *>&buf[offset], attr_len, NULL))
+            offset += attr_len
+        sizes_offset = offset
+        offset += 4 * <Py_ssize_t>n_items
+        directory_map = {}
+        for i in range(n_items):
+            item_size = _u32(buf, sizes_offset + 4 * i, end)
+            child_end = offset + item_size
+            if child_end > end:
+                child_end = end
+            directory_map[item_names[i]] = _parse(mv, buf, offset, child_end)
+            offset += item_size
+        return directory_map
+    return None
+
+
+cpdef object parse_rtfd(object data, Py_ssize_t offset=0):
+    """Parses the RTFD item at offset. Returns memoryview slices of data for
+    single items and a dict for directories, like datastore.read_rtf_item_mv()."""
+    cdef object mv = memoryview(data)
+    cdef const unsigned char[::1] buf = mv
+    return _parse(mv, buf, offset, buf.shape[0])
@@ -22,32 +22,67 @@
 
 # flake8: noqa
 
+import base64
 import errno
 import hashlib
 import os
-from io import IOBase, FileIO, BytesIO
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from io import IOBase, FileIO
 from pathlib import Path
 import plistlib
+import re
+import struct
+import sys
 import uuid as UUID
 import xml.parsers.expat
 from typing import Optional, BinaryIO, Union
 
+try:
+    from lxml import etree
+except ImportError:
+    etree = None
+
+# Optional compiled RTFD parser. See _rtfd.pyx.
+try:
+    import _rtfd
+except ImportError:
+    _rtfd = None
+
 # Disable encryption for now
 # import vpenc
 
 import tokenizer
+import uringio
 from wordtrie import WordTrie
 
 
-def sha1_hash(s):
-    sha1 = hashlib.sha1()
-    sha1.update(s.encode('utf-8'))
-    return sha1.hexdigest()
+# Exceptions raised when a property list contains invalid XML.
+if etree is not None:
+    PLIST_PARSE_ERRORS = (xml.parsers.expat.ExpatError, etree.XMLSyntaxError)
+else:
+    PLIST_PARSE_ERRORS = (xml.parsers.expat.ExpatError,)
+
+# Items with these UTIs have no file associated with them.
+#
+# A page alias only refers to another page. A file alias is stored as an
+# opaque blob created with [NSURL bookmarkDataWithOptions] which we cannot
+# parse at this time.
+SKIP_UTIS = frozenset({'com.fm.page-alias', 'com.fm.file-alias'})
+
+# File reads and libxml2 parsing release the GIL, so a thread pool can overlap
+# them. Converting the parsed plists to dicts and decoding item text are pure
+# Python and do not, so the pool is only used when there are several CPUs and
+# enough files for the overlap to outweigh the cost of the pool.
+IO_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+IO_PARALLEL = (os.cpu_count() or 1) > 1
+IO_PARALLEL_MIN_ITEMS = 64
 
 
 class DataStore:
     def __init__(self):
         self.path = None
+        self._pages = None
         self.encrypted = False
         self.enc_ctx = None
         self.password = None
@@ -61,13 +96,14 @@ class DataStore:
     def create(cls, path):
         ds = cls()
         ds.path = Path(path)
+        ds._pages = os.fspath(Path(path, 'pages'))
 
         ds.in_memory = False
 
         os.mkdir(ds.path)
-        os.mkdir(Path(ds.path, 'pages'))
-        for i in range(0, 16):
-            os.mkdir(Path(ds.path, 'pages', f'{i:x}'))
+        os.makedirs(ds._pages, exist_ok=True)
+        for subdir in [f'{ds._pages}/{i:x}' for i in range(0, 16)]:
+            os.mkdir(subdir)
 
         ds.storeinfo = {
             'isEncrypted': False,
@@ -96,10 +132,12 @@ class DataStore:
         ds.properties['defaultUUID'] = index_uuid
 
         storeinfo_path = Path(ds.path, 'storeinfo.plist')
-        plistlib.dump(ds.storeinfo, open(str(storeinfo_path), 'wb'), fmt=plistlib.FMT_XML)
+        with open(storeinfo_path, 'wb') as fp:
+            plistlib.dump(ds.storeinfo, fp, fmt=plistlib.FMT_XML)
 
         properties_path = Path(ds.path, 'properties.plist')
-        plistlib.dump(ds.properties, open(str(properties_path), 'wb'), fmt=plistlib.FMT_XML)
+        with open(properties_path, 'wb') as fp:
+            plistlib.dump(ds.properties, fp, fmt=plistlib.FMT_XML)
 
         return ds
 
@@ -108,6 +146,7 @@ class DataStore:
         ds = cls()
 
         ds.path = Path(path)
+        ds._pages = os.fspath(Path(path, 'pages'))
         ds.encrypted = False
         ds.enc_ctx = None
         ds.password = password
@@ -123,7 +162,7 @@ class DataStore:
             # FIXME: Raise an error that indicates the vpdoc is invalid or corrupt.
             raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), properties_path)
 
-        ds.storeinfo = plistlib.load(open(str(storeinfo_path), 'rb'), fmt=plistlib.FMT_XML)
+        ds.storeinfo = ds.load_plist(storeinfo_path)
 
         if ds.storeinfo['isEncrypted']:
             raise Exception('Encrypted documents are not supported')
@@ -138,51 +177,36 @@ class DataStore:
 
         ds.properties = ds.load_plist(properties_path)
 
-        items_path = Path(ds.path, 'pages')
-        if not items_path.is_dir():
+        items_path = ds._pages
+        if not os.path.isdir(items_path):
             # FIXME: Raise an error that indicates the vpdoc is invalid or corrupt.
             raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), properties_path)
 
         ds.item_plists = {}
+        ds.items = {}
         # item_plist_paths  = items_path.rglob('*.plist')
-        item_plist_paths = ds.get_plists(items_path)
-        for item_plist_path in item_plist_paths:
+        item_plist_paths, item_files = ds.get_plists(items_path)
+        item_plist_data = ds.read_files(item_plist_paths)
+        for item_uuid, item_plist in ds.map_io(ds.load_item_plist, item_plist_paths, item_plist_data):
             # VoodooPad (or the underlying macOS libraries) may generate
             # invalid XML. Skip the plist (and the associated item) if the XML
             # parser throws an exception.
-            try:
-                item_uuid = item_plist_path.stem
-                item_plist = ds.load_plist(item_plist_path)
-                ds.item_plists[item_uuid] = item_plist
-            except xml.parsers.expat.ExpatError:
+            if isinstance(item_plist, Exception):
                 print(f'Skipping {item_uuid} due to invalid plist')
-                pass
-
-        ds.items = {}
-        for item_uuid in ds.item_plists.keys():
-            item_plist = ds.item_plist(item_uuid)
-
-            # If the current item is a page alias, then there is no file
-            # associated with it.  Skip it and move on to the next item.
-            if item_plist['uti'] in ['com.fm.page-alias']:
                 continue
+            ds.item_plists[item_uuid] = item_plist
 
-            # If the current item is a file alias, skip it and move on to the
-            # next item.  The file alias is stored as an opaque blob created
-            # with [NSURL bookmarkDataWithOptions] which we cannot parse at
-            # this time.
-            if item_plist['uti'] in ['com.fm.file-alias']:
+            # Aliases have no file to load. See SKIP_UTIS.
+            if item_plist['uti'] in SKIP_UTIS:
                 continue
 
-            item_path = ds.item_path(item_uuid)
-
-            if not item_path.exists():
+            if (item_uuid[0], item_uuid) not in item_files:
                 # FIXME: Raise an error that indicates the vpdoc is invalid or corrupt.
-                raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), item_path)
-
-            # RTFD files have some non-utf characters in the header.
+                raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), ds.item_path(item_uuid))
 
-            ds.items[item_uuid] = ds.load_file(item_path).decode('utf-8')
+            # Item contents are read on first access. Use load_items() to
+            # read many items at once.
+            ds.items[item_uuid] = _LazyItem(ds, item_uuid)
 
         return ds
 
@@ -195,26 +219,29 @@ class DataStore:
     def item(self, uuid):
         # TODO: Should item() return the underlying item (e.g., if the uuid is an
         # alias) or should it return something else?
-        return self.items[uuid]
+        return self.items[uuid].value()
 
     def item_plist(self, uuid):
         return self.item_plists[uuid]
 
     def item_path(self, uuid):
-        return Path(self.path, 'pages', uuid[0], uuid)
+        return f'{self._pages}/{uuid[0]}/{uuid}'
 
     def item_plist_path(self, uuid):
-        return Path(self.path, 'pages', uuid[0], '{}.plist'.format(uuid))
+        return f'{self._pages}/{uuid[0]}/{uuid}.plist'
 
-    def validate(self):
+    # If strict is True, stop at the first problem found instead of reporting
+    # every problem.
+    def validate(self, strict=False):
         valid = True
 
         # Validate that the UUIDs match the UUIDs stored in the property lists.
-        for item_uuid in self.item_uuids():
-            item_plist = self.item_plist(item_uuid)
+        for item_uuid, item_plist in self.item_plists.items():
             if item_uuid != item_plist['uuid']:
                 valid = False
                 print('[WARN] UUID mismatch for {}'.format(item_uuid))
+                if strict:
+                    return valid
 
         # TODO: Check the default item exists.
 
@@ -228,7 +255,8 @@ class DataStore:
         item_uuid = str(UUID.uuid4())
         item_key = name.lower()
 
-        data_hash = sha1_hash(text)
+        data = text.encode('utf-8')
+        data_hash = hashlib.sha1(data).hexdigest()
 
         # TODO: Add all fields.
         pl = dict(
@@ -239,24 +267,77 @@ class DataStore:
           dataHash = data_hash
         )
 
-        item_path = Path(self.path, 'pages', item_uuid[0], item_uuid)
-        plist_path = Path(self.path, 'pages', item_uuid[0], item_uuid + '.plist')
+        item_path = self.item_path(item_uuid)
+        plist_path = self.item_plist_path(item_uuid)
 
         # Save to disk
         self.save_plist(pl, plist_path)
-        self.save_file(text.encode('utf-8'), item_path)
+        self.save_file(data, item_path)
 
         # Keep in memory
-        self.items[item_uuid] = text
+        self.items[item_uuid] = _LazyItem(self, item_uuid, text)
         self.item_plists[item_uuid] = pl
 
         return item_uuid
 
+    def map_io(self, fn, *iterables):
+        # The encryption context is not known to be thread safe, so encrypted
+        # documents are loaded serially.
+        iterables = [list(iterable) for iterable in iterables]
+        if self.encrypted or not IO_PARALLEL or len(iterables[0]) < IO_PARALLEL_MIN_ITEMS:
+            return list(map(fn, *iterables))
+        with ThreadPoolExecutor(max_workers=IO_WORKERS) as executor:
+            return list(executor.map(fn, *iterables))
+
+    # Reads the given files in batches with io_uring when it is available.
+    # Otherwise returns None for each file and load_item_plist() and
+    # load_item() read the files themselves.
+    def read_files(self, paths):
+        if self.encrypted or not uringio.available:
+            return [None] * len(paths)
+        return uringio.read_files(paths)
+
+    def load_item_plist(self, path, data=None):
+        item_uuid = os.path.basename(path)[:-len('.plist')]
+        try:
+            if data is None:
+                item_plist = self.load_plist(path)
+            else:
+                item_plist = parse_plist(data)
+        except PLIST_PARSE_ERRORS as e:
+            return item_uuid, e
+
+        # Every item plist has the same keys and only a handful of distinct
+        # UTIs. Intern them so large documents share a single copy of each.
+        item_plist = {sys.intern(k): v for k, v in item_plist.items()}
+        if isinstance(item_plist.get('uti'), str):
+            item_plist['uti'] = sys.intern(item_plist['uti'])
+        return item_uuid, item_plist
+
+    # Reads the contents of the given items (or all items) that have not been
+    # read yet.
+    def load_items(self, uuids=None):
+        if uuids is None:
+            uuids = self.items.keys()
+
+        pending = [uuid for uuid in uuids if uuid in self.items and not self.items[uuid].loaded()]
+        paths = [self.item_path(uuid) for uuid in pending]
+
+        data = self.read_files(paths)
+        for uuid, text in zip(pending, self.map_io(self.load_item, paths, data)):
+            self.items[uuid] = _LazyItem(self, uuid, text)
+
+    def load_item(self, path, data=None):
+        # RTFD files have some non-utf characters in the header.
+        return self.load_file(path, data).decode('utf-8')
+
     def load_plist(self, path):
         if self.encrypted:
             return self.enc_ctx.load_plist(path)
         else:
-            return plistlib.load(open(str(path), 'rb'), fmt=plistlib.FMT_XML)
+            with open(path, 'rb') as fp:
+                buf = fp.read()
+            return parse_plist(buf)
 
     def save_plist(self, plist, path):
         os.makedirs(os.path.dirname(path), exist_ok=True)
@@ -266,14 +347,16 @@ class DataStore:
             with open(path, 'wb') as fp:
                 plistlib.dump(plist, fp)
 
-    def load_file(self, path):
+    def load_file(self, path, file_content=None):
         if self.encrypted:
             return self.enc_ctx.load_file(path)
         else:
-            file_content = open(str(path), 'rb').read()
+            if file_content is None:
+                with open(path, 'rb') as fp:
+                    file_content = fp.read()
             # check if the first 4 bytes are the RTFD magic number
             if len(file_content) > 4 and file_content[0:4] == b'rtfd':
-                return extract_rtf_content_from_rtfd(path)
+                return extract_rtf_content_from_rtfd(path, file_content)
             else:
                 return file_content
 
@@ -287,74 +370,215 @@ class DataStore:
 
     # This is a work-around for Path.rglob('*.plist'). Path.rglob() has issues when running inside
     # Geekbench
+    #
+    # Returns the paths of the item plists and the set of remaining files (the
+    # item files) as (subdirectory, name) pairs, so callers do not need to stat
+    # the item files to check they exist.
     def get_plists(self, dir):
-        subdirs = os.listdir(str(dir))
         plists = []
-        for s in subdirs:
-            path = str(Path(dir, s))
+        files = set()
+        with os.scandir(dir) as subdirs:
+            for s in subdirs:
+                if not s.is_dir(follow_symlinks=False):
+                    continue
 
-            if not os.path.isdir(path):
-                continue
+                with os.scandir(s.path) as entries:
+                    for e in entries:
+                        if e.name.endswith('.plist'):
+                            plists.append(e.path)
+                        else:
+                            files.add((s.name, e.name))
 
-            entries = os.listdir(path)
-            for e in entries:
-                if e.endswith('.plist'):
-                    plists.append(Path(path, e))
-
-        return plists
+        return plists, files
 
     def regenerate_trie(self):
         self.trie = WordTrie()
-        for uuid in self.item_uuids():
-            item = self.item_plist(uuid)
-            name = tokenizer.tokenize_text(item['displayName'].lower())
-            self.trie.add(name)
-
-
-def read_rtf_item(data: Union[IOBase, BinaryIO, FileIO]) -> Union[Optional[bytes], dict[str, Optional[bytes]]]:
-    item_type = read_int(data.read(4))
+        tokenize_text = tokenizer.tokenize_text
+        names = [tokenize_text(item['displayName'].lower()) for item in self.item_plists.values()]
+        add = self.trie.add
+        for name in names:
+            add(name)
+
+
+class _LazyItem:
+    __slots__ = ('ds', 'uuid', '_val')
+
+    def __init__(self, ds, uuid, val=None):
+        self.ds = ds
+        self.uuid = uuid
+        self._val = val
+
+    def loaded(self):
+        return self._val is not None
+
+    def value(self):
+        if self._val is None:
+            self._val = self.ds.load_item(self.ds.item_path(self.uuid))
+        return self._val
+
+
+def parse_plist(data):
+    if etree is not None:
+        return _lxml_plist_root(etree.fromstring(data, _lxml_parser()))
+    else:
+        return plistlib.loads(data, fmt=plistlib.FMT_XML)
+
+
+# libxml2 parses property lists considerably faster than plistlib's expat
+# driven parser. The translation below mirrors what plistlib.load() returns
+# for XML property lists.
+def _lxml_parser():
+    return etree.XMLParser(resolve_entities=False, remove_comments=True)
+
+
+def _lxml_plist_root(root):
+    if root.tag != 'plist' or len(root) != 1:
+        raise ValueError('Invalid property list')
+    return _lxml_plist_value(root[0])
+
+
+def _lxml_plist_value(elem):
+    tag = elem.tag
+    if tag == 'dict':
+        d = {}
+        children = iter(elem)
+        for key in children:
+            if key.tag != 'key':
+                raise ValueError(f'Unexpected <{key.tag}> in dict')
+            value = next(children, None)
+            if value is None:
+                raise ValueError('Missing value for key in dict')
+            d[key.text or ''] = _lxml_plist_value(value)
+        return d
+    elif tag == 'array':
+        return [_lxml_plist_value(child) for child in elem]
+    elif tag == 'string':
+        return elem.text or ''
+    elif tag == 'integer':
+        text = elem.text.strip()
+        if text.startswith('0x') or text.startswith('0X'):
+            return int(text, 16)
+        return int(text)
+    elif tag == 'real':
+        return float(elem.text)
+    elif tag == 'true':
+        return True
+    elif tag == 'false':
+        return False
+    elif tag == 'data':
+        return base64.b64decode((elem.text or '').encode('ascii'))
+    elif tag == 'date':
+        return _plist_date(elem.text or '')
+    raise ValueError(f'Unsupported plist type <{tag}>')
+
+
+# Same format as plistlib, which accepts dates with trailing fields omitted.
+_PLIST_DATE = re.compile(r'(?P<year>\d\d\d\d)(?:-(?P<month>\d\d)(?:-(?P<day>\d\d)'
+                         r'(?:T(?P<hour>\d\d)(?::(?P<minute>\d\d)(?::(?P<second>\d\d))?)?)?)?)?Z', re.ASCII)
+
+
+def _plist_date(text):
+    match = _PLIST_DATE.match(text)
+    if match is None:
+        raise ValueError(f'Invalid plist date {text}')
+    fields = []
+    for key in ('year', 'month', 'day', 'hour', 'minute', 'second'):
+        value = match.group(key)
+        if value is None:
+            break
+        fields.append(int(value))
+    return datetime(*fields)
+
+
+RtfItem = Union[Optional[bytes], dict[str, 'RtfItem']]
+
+
+def read_rtf_item(data: Union[IOBase, BinaryIO, FileIO]) -> RtfItem:
+    item, _ = read_rtf_item_mv(memoryview(data.read()))
+    return _rtf_item_bytes(item)
+
+
+def read_rtf_item_mv(mv: memoryview, offset: int = 0) -> tuple[Union[Optional[memoryview], dict], int]:
+    """Reads the RTFD item at offset. Returns the item and the offset of the
+    byte following it. Item contents are slices of mv rather than copies.
+    Raises ValueError if the item headers are truncated. Item contents that run
+    past the end of mv are cut short, as in _rtfd.parse_rtfd()."""
+    item_type = _rtf_u32(mv, offset)
+    offset += 4
     if item_type == 1:
         # single item
-        item_size = read_int(data.read(4))
+        item_size = _rtf_u32(mv, offset)
+        offset += 4
         if item_size == 2147483648:  # 00 00 00 80 means it is a big file w padding
-            padding_size = read_int(data.read(4))
-            real_size = read_int(data.read(4))
-            data.read(padding_size)  # skip padding
-            return data.read(real_size)
+            padding_size = _rtf_u32(mv, offset)
+            real_size = _rtf_u32(mv, offset + 4)
+            offset += 8 + padding_size  # skip padding
+            return mv[offset:offset + real_size], offset + real_size
         else:
-            return data.read(item_size)
+            return mv[offset:offset + item_size], offset + item_size
     elif item_type == 3:
-        n_items = read_int(data.read(4))
+        n_items = _rtf_u32(mv, offset)
+        offset += 4
         item_names = []
-        directory_map = {}
         for _ in range(n_items):
-            attr_len = read_int(data.read(4))
-            attr_name = data.read(attr_len).decode('utf-8')
-            item_names.append(attr_name)
-            directory_map[attr_name] = None
-        item_sizes = [read_int(data.read(4)) for _ in range(n_items)]
-        item_data = [data.read(size) for size in item_sizes]
-        for i, item in enumerate(item_data):
-            directory_map[item_names[i]] = read_rtf_item(BytesIO(item))
-        return directory_map
+            attr_len = _rtf_u32(mv, offset)
+            offset += 4
+            if offset + attr_len > len(mv):
+                raise ValueError('Truncated RTFD item')
+            item_names.append(str(mv[offset:offset + attr_len], 'utf-8'))
+            offset += attr_len
+        if offset + 4 * n_items > len(mv):
+            raise ValueError('Truncated RTFD item')
+        item_sizes = struct.unpack_from(f'<{n_items}I', mv, offset)
+        offset += 4 * n_items
+        directory_map = {}
+        for name, size in zip(item_names, item_sizes):
+            directory_map[name], _ = read_rtf_item_mv(mv[offset:offset + size])
+            offset += size
+        return directory_map, offset
+    return None, offset
+
+
+def _rtf_u32(mv, offset):
+    if offset + 4 > len(mv):
+        raise ValueError('Truncated RTFD item')
+    return _u32_from(mv, offset)[0]
+
+
+def _rtf_item_bytes(item):
+    if isinstance(item, dict):
+        return {name: _rtf_item_bytes(child) for name, child in item.items()}
+    elif item is not None:
+        return bytes(item)
     return None
 
 
-def read_int(four_bytes: bytes) -> int:
-    return int.from_bytes(four_bytes, byteorder='little')
+_u32_from = struct.Struct('<I').unpack_from
 
 
-def extract_rtf_content_from_rtfd(rtfd_file_path: str) -> Optional[Union[int, bytes]]:
-    """Extracts the first RTF content from an RTFD file. """
-    with open(rtfd_file_path, 'rb') as rtfd_file:
-        if rtfd_file.read(4) != b'rtfd':
-            print("File is not an RTFD file.")
+def extract_rtf_content_from_rtfd(rtfd_file_path: str, data: Optional[bytes] = None) -> Optional[Union[int, bytes]]:
+    """Extracts the first RTF content from an RTFD file. Pass the file contents
+    as data if they have already been read."""
+    if data is None:
+        with open(rtfd_file_path, 'rb') as rtfd_file:
+            data = rtfd_file.read()
+    if data[0:4] != b'rtfd':
+        print("File is not an RTFD file.")
+        return None
+    # Skip the magic number and the following 4 bytes. Wasn't sure what those
+    # are. Version, maybe.
+    try:
+        if _rtfd is not None:
+            contents = _rtfd.parse_rtfd(data, 8)
+        else:
+            contents, _ = read_rtf_item_mv(memoryview(data), 8)
+    except ValueError:
+        print("Could not parse RTFD file.")
+        return None
+    if isinstance(contents, dict):
+        if 'TXT.rtf' in contents:
+            return _rtf_item_bytes(contents['TXT.rtf'])
+        else:
+            print("Could not find TXT.rtf in RTFD file.")
             return None
-        rtfd_file.read(4)  # Wasn't sure what this is. Version, maybe.
-        contents = read_rtf_item(rtfd_file)
-        if isinstance(contents, dict):
-            if 'TXT.rtf' in contents:
-                return contents['TXT.rtf']
-            else:
-                print("Could not find TXT.rtf in RTFD file.")
-                return None
+    return None
@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2004-2022 Primate Labs Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+
+import datetime
+import os
+import plistlib
+import shutil
+import struct
+import tempfile
+import timeit
+import unittest
+from io import BytesIO
+
+import datastore
+
+
+PLIST_HEADER = b'''<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE plist PUBLIC "-//Apple//DTD PLIST 1.0//EN" "http://www.apple.com/DTDs/PropertyList-1.0.dtd">
+<plist version="1.0">
+'''
+
+
+def plist_xml(body):
+    return PLIST_HEADER + body + b'\n</plist>\n'
+
+
+@unittest.skipIf(datastore.etree is None, 'lxml is not installed')
+class PlistTest(unittest.TestCase):
+    def assertParity(self, data):
+        self.assertEqual(datastore.parse_plist(data), plistlib.loads(data, fmt=plistlib.FMT_XML))
+
+    def test_types(self):
+        value = {
+            'string': 'VoodooPad',
+            'unicode': 'café ☃',
+            'empty': '',
+            'integer': 42,
+            'negative': -7,
+            'real': 1.5,
+            'true': True,
+            'false': False,
+            'data': b'\x00\x01\xfe\xff' * 40,
+            'date': datetime.datetime(2021, 7, 14, 20, 45, 36),
+            'array': [1, 'two', [3.0], {}],
+            'dict': {'nested': {'key': 'value'}},
+            'emptyArray': [],
+            'emptyDict': {},
+        }
+        self.assertParity(plistlib.dumps(value, fmt=plistlib.FMT_XML))
+
+    def test_hex_integer(self):
+        self.assertParity(plist_xml(b'<dict><key>n</key><integer>0x1F</integer></dict>'))
+
+    def test_partial_dates(self):
+        for date in [b'2021-07-14T20:45:36Z', b'2021-07-14T20:45Z', b'2021-07-14T20Z', b'2021-07-14Z']:
+            self.assertParity(plist_xml(b'<array><date>' + date + b'</date></array>'))
+
+    def test_comments(self):
+        self.assertParity(plist_xml(b'<dict><!-- c --><key>a</key><!-- c --><string>b</string></dict>'))
+
+    def test_missing_value(self):
+        data = plist_xml(b'<dict><key>a</key><string>b</string><key>c</key></dict>')
+        with self.assertRaises(ValueError):
+            plistlib.loads(data, fmt=plistlib.FMT_XML)
+        with self.assertRaises(ValueError):
+            datastore.parse_plist(data)
+
+
+class DataStoreTest(unittest.TestCase):
+    def test_open(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'Test.vpdoc')
+            ds = datastore.DataStore.create(path)
+            item_uuid = ds.add_item('Atari ST', 'The Atari ST.', 'public.utf8-plain-text')
+
+            ds = datastore.DataStore.open(path)
+            self.assertEqual(len(ds.item_uuids()), 2)
+            self.assertEqual(ds.item(item_uuid), 'The Atari ST.')
+            self.assertTrue(ds.validate())
+
+    def test_item_in_wrong_directory(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'Test.vpdoc')
+            ds = datastore.DataStore.create(path)
+            item_uuid = ds.add_item('Atari ST', 'The Atari ST.', 'public.utf8-plain-text')
+
+            item_path = ds.item_path(item_uuid)
+            other = '0' if item_uuid[0] != '0' else '1'
+            shutil.move(item_path, os.path.join(path, 'pages', other, item_uuid))
+
+            with self.assertRaises(FileNotFoundError):
+                datastore.DataStore.open(path)
+
+
+def rtf_single(data):
+    return struct.pack('<II', 1, len(data)) + data
+
+
+def rtf_big(data, padding=3):
+    return struct.pack('<IIII', 1, 0x80000000, padding, len(data)) + b'\0' * padding + data
+
+
+def rtf_dir(entries):
+    names = b''.join(struct.pack('<I', len(name.encode())) + name.encode() for name, _ in entries)
+    sizes = b''.join(struct.pack('<I', len(item)) for _, item in entries)
+    return struct.pack('<II', 3, len(entries)) + names + sizes + b''.join(item for _, item in entries)
+
+
+def rtfd(item):
+    return b'rtfd' + b'\0\0\0\0' + item
+
+
+RTF = '{\\rtf1 héllo}'.encode('utf-8')
+
+NESTED = rtf_dir([
+    ('TXT.rtf', rtf_single(RTF)),
+    ('pics', rtf_dir([('a.png', rtf_single(b'\x89PNG' * 100)), ('b', rtf_big(b'xyz'))])),
+    ('big', rtf_big(b'B' * 5000)),
+])
+
+NESTED_EXPECTED = {
+    'TXT.rtf': RTF,
+    'pics': {'a.png': b'\x89PNG' * 100, 'b': b'xyz'},
+    'big': b'B' * 5000,
+}
+
+
+class RtfdTest(unittest.TestCase):
+    def test_single(self):
+        self.assertEqual(datastore.read_rtf_item(BytesIO(rtf_single(b'abc'))), b'abc')
+
+    def test_big(self):
+        self.assertEqual(datastore.read_rtf_item(BytesIO(rtf_big(b'abc'))), b'abc')
+
+    def test_nested(self):
+        self.assertEqual(datastore.read_rtf_item(BytesIO(NESTED)), NESTED_EXPECTED)
+
+    def test_extract(self):
+        self.assertEqual(datastore.extract_rtf_content_from_rtfd(None, rtfd(NESTED)), RTF)
+
+    def test_extract_file(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'item')
+            with open(path, 'wb') as fp:
+                fp.write(rtfd(NESTED))
+            self.assertEqual(datastore.extract_rtf_content_from_rtfd(path), RTF)
+
+    def test_missing_txt(self):
+        data = rtfd(rtf_dir([('a.png', rtf_single(b'png'))]))
+        self.assertIsNone(datastore.extract_rtf_content_from_rtfd(None, data))
+
+    def test_truncated(self):
+        data = rtfd(NESTED)
+        for n in range(len(data)):
+            content = datastore.extract_rtf_content_from_rtfd(None, data[:n])
+            self.assertTrue(content is None or isinstance(content, bytes))
+
+        # The header is cut off after the number of items.
+        self.assertIsNone(datastore.extract_rtf_content_from_rtfd(None, data[:16]))
+
+    def test_truncated_raises_value_error(self):
+        with self.assertRaises(ValueError):
+            datastore.read_rtf_item(BytesIO(NESTED[:6]))
+        with self.assertRaises(ValueError):
+            datastore.read_rtf_item(BytesIO(NESTED[:12]))
+
+
+@unittest.skipIf(datastore._rtfd is None, '_rtfd is not built')
+class CompiledRtfdTest(unittest.TestCase):
+    def parse_both(self, data):
+        try:
+            item, _ = datastore.read_rtf_item_mv(memoryview(data))
+            pure = datastore._rtf_item_bytes(item)
+        except ValueError:
+            pure = ValueError
+        try:
+            compiled = datastore._rtf_item_bytes(datastore._rtfd.parse_rtfd(data))
+        except ValueError:
+            compiled = ValueError
+        return pure, compiled
+
+    def test_parity(self):
+        cases = [rtf_single(b'abc'), rtf_big(b'abc'), NESTED, rtf_dir([('a.png', rtf_single(b'png'))])]
+        for data in cases:
+            pure, compiled = self.parse_both(data)
+            self.assertEqual(pure, compiled)
+
+    def test_truncated_parity(self):
+        for n in range(len(NESTED)):
+            pure, compiled = self.parse_both(NESTED[:n])
+            self.assertEqual(pure, compiled, n)
+
+    def test_large_attachments(self):
+        # Attachments the caller does not need should not be copied, so the
+        # compiled parser should not be slower than the pure Python one.
+        attachments = [(f'image{i}.png', rtf_single(os.urandom(500 * 1024))) for i in range(20)]
+        data = rtfd(rtf_dir([('TXT.rtf', rtf_single(b'x' * 200 * 1024))] + attachments))
+
+        def extract():
+            return datastore.extract_rtf_content_from_rtfd(None, data)
+
+        compiled = min(timeit.repeat(extract, number=20, repeat=5))
+        compiled_content = extract()
+
+        rtfd_module = datastore._rtfd
+        datastore._rtfd = None
+        try:
+            pure = min(timeit.repeat(extract, number=20, repeat=5))
+            pure_content = extract()
+        finally:
+            datastore._rtfd = rtfd_module
+
+        self.assertEqual(compiled_content, pure_content)
+        self.assertLess(compiled, pure * 2)
@@ -46,8 +46,11 @@ def is_wikiword(word):
     return False
 
 
+TOKEN_SEPARATORS = re.compile(r"[\s\r\n;,.()-]+")
+
+
 def tokenize_text(text):
-    return re.split(r"[\s\r\n;,.()-]+", text)
+    return TOKEN_SEPARATORS.split(text)
 
 
 def lookup_name(words, start, trie):
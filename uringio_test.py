@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+# Copyright (c) 2004-2022 Primate Labs Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import uringio
+
+
+@unittest.skipUnless(uringio.available, 'io_uring is not available')
+class UringIOTest(unittest.TestCase):
+    def test_read_files(self):
+        sizes = [0, 1, uringio.READ_SIZE - 1, uringio.READ_SIZE, uringio.READ_SIZE + 1, 3 * uringio.READ_SIZE + 7]
+
+        # Enough files for several batches, with each size in every batch.
+        n_files = 2 * uringio.BATCH_SIZE + 5
+
+        with tempfile.TemporaryDirectory() as tmp:
+            paths = []
+            expected = []
+            for i in range(n_files):
+                data = os.urandom(sizes[i % len(sizes)])
+                path = os.path.join(tmp, str(i))
+                with open(path, 'wb') as fp:
+                    fp.write(data)
+                paths.append(path)
+                expected.append(data)
+
+            self.assertEqual(uringio.read_files(paths), expected)
+            self.assertEqual(uringio.read_files([]), [])
+
+    def test_missing_file(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            with self.assertRaises(FileNotFoundError):
+                uringio.read_files([os.path.join(tmp, 'missing')])
+
+    def write_files(self, tmp, n_files):
+        paths = []
+        for i in range(n_files):
+            path = os.path.join(tmp, str(i))
+            with open(path, 'wb') as fp:
+                fp.write(str(i).encode())
+            paths.append(path)
+        return paths
+
+    def test_submit_failure(self):
+        # Nothing is submitted. read_files must raise rather than wait for
+        # completions that will never arrive.
+        with tempfile.TemporaryDirectory() as tmp:
+            paths = self.write_files(tmp, 3)
+            with mock.patch.object(uringio.liburing, 'io_uring_submit', return_value=0):
+                with self.assertRaises(OSError):
+                    uringio.read_files(paths)
+
+    def test_partial_submit(self):
+        submit = uringio.liburing.io_uring_submit
+
+        # Report one entry per call, as if the kernel accepted them one at a
+        # time, so read_files has to keep submitting.
+        def submit_one(ring):
+            submit(ring)
+            return 1
+
+        with tempfile.TemporaryDirectory() as tmp:
+            paths = self.write_files(tmp, 3)
+            with mock.patch.object(uringio.liburing, 'io_uring_submit', submit_one):
+                self.assertEqual(uringio.read_files(paths), [b'0', b'1', b'2'])
@@ -101,6 +101,9 @@ class VPCache:
         if len(updated_items) == 0 and len(new_items) == 0:
             return
 
+        # Read the changed items up front rather than one at a time.
+        ds.load_items(updated_items + new_items)
+
         # Delete keywords for updated items.
         for uuid in updated_items:
             cursor.execute('DELETE FROM refs WHERE uuid = ?', (uuid,))